@@ -1,12 +1,23 @@
 import os
-import glob
+import numpy as np
 import pyutau
 import sys
 import time
 import traceback
 import csv
+import json
+from collections import Counter
+from itertools import zip_longest
+from multiprocessing import freeze_support
+import concurrent.futures
+from functools import partial
 from argparse import ArgumentParser
 
+cache_name = 'stats_cache.json'
+ust_tally_version = 2 # Bump when tally_ust counts differently, so the cached UST tallies are read again
+
+ngram_names = {1 : 'Monophone', 2 : 'Diphone', 3 : 'Triphone'}
+
 notes = ['C', 'C#', 'D', 'D#', 'E', 'F', 'F#', 'G', 'G#', 'A', 'A#', 'B']
 
 def midi_to_note(x):
@@ -17,179 +28,284 @@ def midi_to_note(x):
 def midi_to_hz(x):
     return 440 * (2 ** ((x - 69) / 12))
 
-try:
-    parser = ArgumentParser(description='Calculates some statistics for your existing NNSVS database')
-    parser.add_argument('db', help="The database's folder location")
-    parser.add_argument('--all-labs', '-l', action='store_true', help="Include all LABs in the LAB pass.")
-    parser.add_argument('--include-pau', '-p', action='store_true', help="Include pau phoneme in the phoneme tally passes.")
-    parser.add_argument('--skip-diphone', '-s', action='store_true', help="Skip diphone density in calculations.")
-    parser.add_argument('--write-diphone', '-w', action='store_true', help="Include diphone density in the .csv version.")
-
-    args, _ = parser.parse_known_args()
-    db = args.db
-    calc_diphone = not args.skip_diphone
-    
-    print('Finding all USTs . . . ')
-    usts = glob.glob(db + '/**/*.ust', recursive=True)
-
-    print('Finding corresponding LABs . . . ')
-    labs = []
-    if not args.all_labs:
-        for i in usts:
-            _, file = os.path.split(i)
-            fname, _ = os.path.splitext(file)
-            labs.extend(glob.glob(db + f'/**/{fname}.lab', recursive=True))
-    else:
-        labs = glob.glob(db + '/**/*.lab', recursive=True)
-
-    print('Reading LABs . . . ')
-    phones = []
-    for i in labs:
-        temp = []
-        with open(i) as f:
-            for j in f.readlines():
-                temp.append(j.strip().split()[-1])
-        phones.append(temp)
-
-    print('Tallying phonemes . . . ')
-    mono_dens = {}
-    for i in phones:
-        for p in i:
-            if p != 'pau' or args.include_pau:
-                try:
-                    mono_dens[p] += 1
-                except KeyError:
-                    mono_dens[p] = 1
-
-    mono_dens = dict(sorted(mono_dens.items(), key=lambda x : x[1], reverse=True))
-
-    if calc_diphone:
-        print('Tallying diphones . . . ')
-        diph_dens = {}
-        for i in phones:
-            N = len(i)
-            for j in range(0, N-2):
-                k = i[j] + ' ' + i[j+1]
-                if (i[j] != 'pau' and i[j+1] != 'pau') or args.include_pau:
-                    try:
-                        diph_dens[k] += 1
-                    except KeyError:
-                        diph_dens[k] = 1
-
-        diph_dens = dict(sorted(diph_dens.items(), key=lambda x : x[1], reverse=True))
-    
-    print('Tallying notes . . . ')
-    note_dens_length = {}
-    note_dens_presence = {}
-    note_count = 0
-    for i in usts:
-        ust = pyutau.UtauPlugin(i)
-        del ust.notes[-1]
-        for note in ust.notes:
-            if note.lyric not in ['R', 'pau']:
-                note_count += 1
-                try:
-                    note_dens_length[note.note_num] += note.length
-                except KeyError:
-                    note_dens_length[note.note_num] = note.length
-
-                try:
-                    note_dens_presence[note.note_num] += 1
-                except KeyError:
-                    note_dens_presence[note.note_num] = 1
-
-    print('Calculating things idk . . . ')
-    note_dens_length = dict(sorted(note_dens_length.items(), reverse=True))
-    note_dens_presence = dict(sorted(note_dens_presence.items(), reverse=True))
-    total_note_length = sum(note_dens_length.values())
-    mean_note = 0
-    for k, v in note_dens_length.items():
-        mean_note += k * v
-    mean_note /= total_note_length
-
-    note_range = list(note_dens_length.keys())
-    lo_range = midi_to_note(note_range[-1])
-    hi_range = midi_to_note(note_range[0])
-    lo_hz = midi_to_hz(note_range[-1])
-    hi_hz = midi_to_hz(note_range[0])
-    closest_note = midi_to_note(int(round(mean_note)))
-    mean_hz = midi_to_hz(mean_note)
-
-    basic_info = {
-            'Overall Range' : f'{lo_range} ~ {hi_range} ({lo_hz:.3f} ~ {hi_hz:.3f})',
-            'Note Count' : note_count,
-            'Total Note Length (UTAU length)' : total_note_length,
-            'Average Pitch' : f'{mean_hz:.3f} Hz (~{closest_note})'
+def index_files(root, exts):
+    # Walks the folder once and groups the files with the given extensions by extension, then by name without extension.
+    # Skips hidden files and folders and lists files in the same order as a recursive glob does.
+    index = {ext : {} for ext in exts}
+    stack = [root]
+    while stack:
+        folders = []
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    folders.append(entry.path)
+                    continue
+                stem, ext = os.path.splitext(entry.name)
+                ext = os.path.normcase(ext)
+                if ext in index:
+                    index[ext].setdefault(stem, []).append(entry.path)
+        stack.extend(reversed(folders))
+    return index
+
+def ngram_name(n):
+    return ngram_names.get(n, f'{n}-phone')
+
+def read_phonemes(path):
+    with open(path) as f:
+        return [fields[-1] for fields in map(str.split, f) if fields]
+
+#Every file is tallied on its own and the partial tallies are merged in file order,
+#so running them in a pool gives the same counts in the same order as running them one by one.
+#Only one file's phonemes are held at a time, the totals grow with the number of different runs and not the database.
+def tally_lab(path, include_pau=False, ngram=2):
+    #Counts every run of 1 to ngram phonemes, keyed by tuples of phonemes. Runs with pau are left out unless include_pau.
+    phones = read_phonemes(path)
+    dens = []
+    for n in range(1, ngram + 1):
+        counts = Counter(zip(*[phones[i:] for i in range(n)]))
+        if not include_pau:
+            for gram in [gram for gram in counts if 'pau' in gram]:
+                del counts[gram]
+        dens.append(counts)
+
+    return dens
+
+def tally_ust(path):
+    #Note length and presence per note number, counted over the whole file at once.
+    #Only TRACKEND is left out at the end. Before version 2 the last note was always dropped, which lost a real note
+    #in USTs without a TRACKEND.
+    table = pyutau.note_table(path, rest_lyrics=['R', 'pau'])
+    sung = ~table.rest
+    note_num = table.note_num[sung]
+    note_dens_length = np.bincount(note_num, weights=table.length[sung])
+    note_dens_presence = np.bincount(note_num)
+    present = np.flatnonzero(note_dens_presence)
+
+    return {int(k) : int(note_dens_length[k]) for k in present}, {int(k) : int(note_dens_presence[k]) for k in present}, int(np.count_nonzero(sung))
+
+def csv_rows(tables):
+    #Lays the (header, rows) tables side by side with an empty column between them.
+    #Every table is walked once, so this stays linear however long the diphone column gets.
+    widths = [len(header) for header, _ in tables]
+    yield [cell for k, (header, _) in enumerate(tables) for cell in ([''] if k else []) + header]
+    for cells in zip_longest(*(rows for _, rows in tables)):
+        row = []
+        for k, (cell, width) in enumerate(zip(cells, widths)):
+            if k:
+                row.append('')
+            row.extend([''] * width if cell is None else cell)
+        yield row
+
+def jsonl_lines(tables):
+    #One JSON object per line, each tagged with its table so the big n-gram tables can be streamed back in
+    for name, rows in tables.items():
+        for row in rows:
+            yield json.dumps({'table' : name, **row}, ensure_ascii=False) + '\n'
+
+def map_files(executor, func, paths, workers):
+    #Results come back in the same order as paths either way
+    if executor is None:
+        return map(func, paths)
+    return executor.map(func, paths, chunksize=max(1, len(paths) // (4 * workers)))
+
+#Keeps the tally of every file between runs, so only new or changed files are read again.
+#Files that are gone are dropped from the cache on save, which takes them out of the totals.
+class TallyCache:
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, cache_name)
+        self.entries = {}
+        self.seen = {}
+        self.changed = False
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def get(self, path, params):
+        #Returns the cached tally, or None if the file has to be read again
+        key = self.key(path)
+        stat = os.stat(path)
+        self.seen[key] = (stat.st_mtime_ns, stat.st_size)
+        entry = self.entries.get(key)
+        if entry is None or entry['params'] != params or entry['mtime'] != stat.st_mtime_ns or entry['size'] != stat.st_size:
+            return None
+        #JSON has no int or tuple keys, so the counts are kept as [key, count] pairs
+        return tuple(dict((tuple(k) if isinstance(k, list) else k, v) for k, v in x) if isinstance(x, list) else x for x in entry['tally'])
+
+    def put(self, path, params, tally):
+        key = self.key(path)
+        mtime, size = self.seen[key] # The stat from before the file was read
+        self.entries[key] = {
+            'mtime' : mtime,
+            'size' : size,
+            'params' : params,
+            'tally' : [list(x.items()) if isinstance(x, dict) else x for x in tally]
         }
+        self.changed = True
+
+    def save(self):
+        if not self.changed and len(self.entries) == len(self.seen):
+            return
+        self.entries = {k : v for k, v in self.entries.items() if k in self.seen}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps(self.entries)) # dumps uses the C encoder, dump to a file doesn't
+        os.replace(temp_path, self.path)
+
+def tally_files(executor, func, paths, workers, cache=None, params=None):
+    if cache is None:
+        return map_files(executor, func, paths, workers)
 
-    print('Writing out stats in a text file . . . ')
-    with open(db + '/stats.txt', 'w') as f:
-        for k, v in basic_info.items():
-            f.write(f'{k}: {str(v)}\n')
+    tallies = [cache.get(path, params) for path in paths]
+    stale = [i for i, tally in enumerate(tallies) if tally is None]
+    print(f'Reading {len(stale)} of {len(paths)} files, the rest are unchanged . . . ')
+    for i, tally in zip(stale, map_files(executor, func, [paths[i] for i in stale], workers)):
+        tallies[i] = tally
+        cache.put(paths[i], params, tally)
+    return tallies
 
-        f.write(f'\nNote Density (based on note length)\n')
+if __name__ == '__main__':
+    freeze_support()
+    try:
+        parser = ArgumentParser(description='Calculates some statistics for your existing NNSVS database')
+        parser.add_argument('db', help="The database's folder location")
+        parser.add_argument('--all-labs', '-l', action='store_true', help="Include all LABs in the LAB pass.")
+        parser.add_argument('--include-pau', '-p', action='store_true', help="Include pau phoneme in the phoneme tally passes.")
+        parser.add_argument('--skip-diphone', '-s', action='store_true', help="Skip diphone density in calculations.")
+        parser.add_argument('--write-diphone', '-w', action='store_true', help="Include diphone density in the .csv version.")
+        parser.add_argument('--write-jsonl', '-j', action='store_true', help='Also write every table, n-gram tables included, to stats.jsonl with one JSON object per line.')
+        parser.add_argument('--ngram', '-g', type=int, default=2, help='Tally runs of up to this many phonemes. 2 counts diphones, 3 counts triphones as well and so on. Default is 2.')
+        parser.add_argument('--num-threads', '-n', type=int, default=1, help='How many threads to read the files with. Default is running single threaded. Input zero to use all available threads.')
+        parser.add_argument('--incremental', '-i', action='store_true', help=f'Only read the USTs and LABs that changed since the last run. Keeps the tallies of every file in {cache_name} inside the database folder.')
+
+        args, _ = parser.parse_known_args()
+        db = args.db
+        ngram = 1 if args.skip_diphone else max(1, args.ngram)
+        calc_diphone = ngram >= 2
+        workers = (os.cpu_count() or 1) if args.num_threads <= 0 else args.num_threads # Zero or less means all available threads
+        cache = TallyCache(db) if args.incremental else None
+        lab_params = {'include_pau' : args.include_pau, 'ngram' : ngram}
+        ust_params = {'version' : ust_tally_version}
+
+        print('Finding all USTs and LABs . . . ')
+        index = index_files(db, ['.ust', '.lab'])
+        usts = [path for paths in index['.ust'].values() for path in paths]
+
+        print('Finding corresponding LABs . . . ')
+        labs = []
+        if not args.all_labs:
+            for i in usts:
+                _, file = os.path.split(i)
+                fname, _ = os.path.splitext(file)
+                labs.extend(index['.lab'].get(fname, []))
+        else:
+            labs = [path for paths in index['.lab'].values() for path in paths]
+
+        executor = None
+        if workers > 1:
+            print(f'Starting process pool with {workers} threads . . . ')
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+        try:
+            print('Tallying phonemes . . . ')
+            ngram_dens = [Counter() for n in range(ngram)]
+            for dens in tally_files(executor, partial(tally_lab, **lab_params), labs, workers, cache, lab_params):
+                for total, part in zip(ngram_dens, dens):
+                    total.update(part)
+
+            print('Tallying notes . . . ')
+            note_dens_length = Counter()
+            note_dens_presence = Counter()
+            note_count = 0
+            for length, presence, count in tally_files(executor, tally_ust, usts, workers, cache, ust_params):
+                note_dens_length.update(length)
+                note_dens_presence.update(presence)
+                note_count += count
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        if cache is not None:
+            cache.save()
+
+        ngram_dens = [{' '.join(k) : v for k, v in dens.most_common()} for dens in ngram_dens]
+        mono_dens = ngram_dens[0]
+        diph_dens = ngram_dens[1] if calc_diphone else {}
+
+        print('Calculating things idk . . . ')
+        note_dens_length = dict(sorted(note_dens_length.items(), reverse=True))
+        note_dens_presence = dict(sorted(note_dens_presence.items(), reverse=True))
+        total_note_length = sum(note_dens_length.values())
+        mean_note = 0
         for k, v in note_dens_length.items():
-            f.write(f'{midi_to_note(k)}: {v}\n')
-
-        f.write(f'\nNote Density (based on note presence)\n')
-        for k, v in note_dens_presence.items():
-            f.write(f'{midi_to_note(k)}: {v}\n')
-
-        f.write(f'\nMonophone Density\n')
-        for k, v in mono_dens.items():
-            f.write(f'{k}: {v}\n')
-
-        if calc_diphone:
-            f.write(f'\nDiphone Density\n')
-            for k, v in diph_dens.items():
-                f.write(f'{k}: {v}\n')
-
-    print('Writing out stats in a .csv file . . . ')
-    header = ['Note', 'Density (lengths)', 'Density (presence)', '', 'Phoneme', 'Density', '', '', '']
-
-    if calc_diphone and args.write_diphone:
-        header = header[:7] + ['Diphone', 'Density', ''] + header[7:]
-
-    cols = len(header)
-    rows = max(len(note_dens_length), len(mono_dens)) + 1
-
-    if calc_diphone and args.write_diphone:
-        rows = max(len(note_dens_length), len(mono_dens), len(diph_dens)) + 1
-
-    sheet = [['' for c in range(cols)] for r in range(rows)]
-
-    sheet[0] = header
-    for r in range(1, rows):
-        i = r - 1
-        if i < len(note_dens_length):
-            dens_len = list(note_dens_length.items())[i]
-            dens_pres = list(note_dens_presence.values())[i]
-            sheet[r][0] = midi_to_note(dens_len[0])
-            sheet[r][1] = dens_len[1]
-            sheet[r][2] = dens_pres
-
-        if i < len(mono_dens):
-            dens = list(mono_dens.items())[i]
-            sheet[r][4] = dens[0]
-            sheet[r][5] = dens[1]
-
-        if calc_diphone and args.write_diphone:
-            if i < len(diph_dens):
-                dens = list(diph_dens.items())[i]
-                sheet[r][7] = dens[0]
-                sheet[r][8] = dens[1]
-
-        if i < len(basic_info):
-            info = list(basic_info.items())[i]
-            sheet[r][-2] = info[0]
-            sheet[r][-1] = info[1]
-
-    with open(db + '/stats.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerows(sheet)
+            mean_note += k * v
+        mean_note /= total_note_length
+
+        note_range = list(note_dens_length.keys())
+        lo_range = midi_to_note(note_range[-1])
+        hi_range = midi_to_note(note_range[0])
+        lo_hz = midi_to_hz(note_range[-1])
+        hi_hz = midi_to_hz(note_range[0])
+        closest_note = midi_to_note(int(round(mean_note)))
+        mean_hz = midi_to_hz(mean_note)
+
+        basic_info = {
+                'Overall Range' : f'{lo_range} ~ {hi_range} ({lo_hz:.3f} ~ {hi_hz:.3f})',
+                'Note Count' : note_count,
+                'Total Note Length (UTAU length)' : total_note_length,
+                'Average Pitch' : f'{mean_hz:.3f} Hz (~{closest_note})'
+            }
+
+        print('Writing out stats in a text file . . . ')
+        with open(db + '/stats.txt', 'w') as f:
+            for k, v in basic_info.items():
+                f.write(f'{k}: {str(v)}\n')
+
+            f.write(f'\nNote Density (based on note length)\n')
+            for k, v in note_dens_length.items():
+                f.write(f'{midi_to_note(k)}: {v}\n')
+
+            f.write(f'\nNote Density (based on note presence)\n')
+            for k, v in note_dens_presence.items():
+                f.write(f'{midi_to_note(k)}: {v}\n')
+
+            for n, dens in enumerate(ngram_dens, 1):
+                f.write(f'\n{ngram_name(n)} Density\n')
+                for k, v in dens.items():
+                    f.write(f'{k}: {v}\n')
+
+        print('Writing out stats in a .csv file . . . ')
+        tables = [
+            (['Note', 'Density (lengths)', 'Density (presence)'], ([midi_to_note(k), v, p] for (k, v), p in zip(note_dens_length.items(), note_dens_presence.values()))),
+            (['Phoneme', 'Density'], (list(x) for x in mono_dens.items()))
+        ]
+        if args.write_diphone:
+            tables.extend(([ngram_name(n), 'Density'], (list(x) for x in dens.items())) for n, dens in enumerate(ngram_dens[1:], 2))
+        tables.append((['', ''], (list(x) for x in basic_info.items())))
+
+        with open(db + '/stats.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerows(csv_rows(tables))
+
+        if args.write_jsonl:
+            print('Writing out stats in a .jsonl file . . . ')
+            tables = {
+                'Info' : ({'name' : k, 'value' : v} for k, v in basic_info.items()),
+                'Note' : ({'note' : midi_to_note(k), 'note_num' : k, 'length' : v, 'presence' : note_dens_presence[k]} for k, v in note_dens_length.items())
+            }
+            for n, dens in enumerate(ngram_dens, 1):
+                tables[ngram_name(n)] = ({'phonemes' : k.split(' '), 'density' : v} for k, v in dens.items())
+
+            with open(db + '/stats.jsonl', 'w', encoding='utf-8') as f:
+                f.writelines(jsonl_lines(tables))
     
-except Exception as e:
-    for i in traceback.format_exception(e.__class__, e, e.__traceback__):
-        print(i, end='')
+    except Exception as e:
+        for i in traceback.format_exception(e.__class__, e, e.__traceback__):
+            print(i, end='')
 
-_ = input('Press enter to continue . . . ')
+    _ = input('Press enter to continue . . . ')
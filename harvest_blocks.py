@@ -0,0 +1,74 @@
+import numpy as np
+import soundfile as sf
+import pyworld as world
+import concurrent.futures
+
+#Runs Harvest over a long file in blocks so only a few blocks are ever in memory at once.
+#Each block is read with extra margin on both sides and only the frames in its middle are kept,
+#which hides the edge effects of running Harvest on a cut up signal.
+
+def analyze_block(x, fs, f0_ceil, frame_period, frame_func=None):
+    f0, t = world.harvest(x, fs, f0_ceil=f0_ceil, frame_period=frame_period)
+    values = frame_func(x, f0, t, fs) if frame_func else None
+    return f0, values
+
+def harvest_blocks(path, f0_ceil=world.default_f0_ceil, frame_period=world.default_frame_period, block_seconds=60, margin_seconds=0.5, workers=1, frame_func=None):
+    #frame_func(x, f0, t, fs) may return extra per-frame values for each block (like amplitude), stitched the same way as f0.
+    #It has to be picklable when workers > 1.
+    info = sf.info(path)
+    fs = info.samplerate
+    frame_samples = frame_period * fs / 1000
+    n_frames = 1 + int(1000 * info.frames / fs / frame_period) # Same frame count Harvest gives for the whole file
+
+    block_frames = max(1, int(block_seconds * 1000 / frame_period))
+    step = max(1, int(round(block_frames * frame_samples)))
+    margin = int(round(margin_seconds * fs))
+
+    t = np.arange(n_frames) * frame_period / 1000
+    f0 = np.zeros(n_frames)
+    values = None
+
+    def stitch(k, start, result):
+        nonlocal values
+        block_f0, block_values = result
+        g0, g1 = spans[k]
+        #Nearest block frame for every kept frame. Exact when the frame period is a whole number of samples
+        idx = np.clip(np.round(np.arange(g0, g1) - start / frame_samples).astype(np.int64), 0, len(block_f0) - 1)
+        f0[g0:g1] = block_f0[idx]
+        if block_values is not None:
+            if values is None:
+                values = np.zeros(n_frames)
+            values[g0:g1] = block_values[idx]
+
+    spans = {}
+    pending = {}
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        for k, block in enumerate(sf.blocks(path, blocksize=step + 2 * margin, overlap=2 * margin)):
+            if block.ndim == 2:
+                block = np.mean(block, axis=1)
+            start = k * step
+            g0 = 0 if k == 0 else int(np.ceil((start + margin) / frame_samples))
+            g1 = n_frames if start + len(block) >= info.frames else min(n_frames, int(np.ceil((start + step + margin) / frame_samples)))
+            if g0 >= g1:
+                continue
+            spans[k] = (g0, g1)
+
+            if executor is None:
+                stitch(k, start, analyze_block(block, fs, f0_ceil, frame_period, frame_func))
+                continue
+
+            #Bounds how many blocks are waiting in the pool at once
+            pending[executor.submit(analyze_block, block, fs, f0_ceil, frame_period, frame_func)] = (k, start)
+            if len(pending) >= 2 * workers:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    stitch(*pending.pop(future), future.result())
+
+        for future in concurrent.futures.as_completed(pending):
+            stitch(*pending[future], future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return f0, t, fs, values
@@ -7,97 +7,216 @@ import soundfile as sf
 import pyworld as world
 import sys
 import time
-import struct
 import os
 import traceback
+import json
 from multiprocessing import freeze_support
-import concurrent.futures
+from functools import partial
 from argparse import ArgumentParser
+import frqfile
+from harvest_blocks import harvest_blocks
+import world_cache
+import job_pool
 
 f0_floor = world.default_f0_floor
 f0_ceil = world.default_f0_ceil
+manifest_name = 'frq_manifest.json'
+amp_modes = ['cheaptrick', 'rms']
 
 def base_frq(f0, f0_min=None, f0_max=None):
-    q = 0
-    avg_frq = 0
-    tally = 0
-    N = len(f0)
-
     if f0_min is None:
         f0_min = f0_floor
 
     if f0_max is None:
         f0_max = f0_ceil
-    
-    for i in range(N):
-        if f0[i] >= f0_min and f0[i] <= f0_max:
-            if i < 1:
-                q = f0[i+1] - f0[i]
-            elif i == N - 1:
-                q = f0[i] - f0[i-1]
-            else:
-                q = (f0[i+1] - f0[i-1]) / 2
-            weight = 2 ** (-q * q)
-            avg_frq += f0[i] * weight
-            tally += weight
+
+    f0 = np.asarray(f0, dtype=np.float64)
+    if f0.shape[0] < 2:
+        q = np.zeros_like(f0)
+    else:
+        q = np.gradient(f0) # centered difference, one-sided at the edges
+
+    voiced = (f0 >= f0_min) & (f0 <= f0_max)
+    weight = np.exp2(-q[voiced] * q[voiced])
+    tally = np.sum(weight)
 
     if tally > 0:
-        avg_frq /= tally
-    return avg_frq
+        return np.sum(f0[voiced] * weight) / tally
+    return 0
+
+def frame_rms(x, t, fs, hop):
+    #RMS over 2 * hop samples centered on each frame. Uses a running sum of squares so no frame matrix is made
+    power = np.concatenate(([0], np.cumsum(np.square(x))))
+    center = np.round(t * fs).astype(np.int64)
+    start = np.clip(center - hop, 0, len(x))
+    end = np.clip(center + hop, 0, len(x))
+    return np.sqrt(np.maximum(power[end] - power[start], 0) / np.maximum(end - start, 1))
+
+def cheaptrick_amp(x, f0, t, fs):
+    sp = world.cheaptrick(x, f0, t, fs)
+    return np.mean(np.sqrt(sp), axis=1)
+
+def rms_amp(x, f0, t, fs, hop=256):
+    return frame_rms(x, t, fs, hop)
 
-def frq_gen(floc, f0_max=880, hop=256):
+def frq_gen(floc, f0_max=880, hop=256, amp_mode='cheaptrick', block_seconds=0, workers=1, cache_dir=None):
     t0 = time.perf_counter()
     fname, _ = os.path.splitext(floc)
     basename = os.path.basename(fname)
-    logging.info(f'Making {basename}_wav.frq 1/4')
-    x, fs = sf.read(floc)
+    amp_func = partial(rms_amp, hop=hop) if amp_mode == 'rms' else cheaptrick_amp
 
-    logging.info(f'Making {basename}_wav.frq 2/4')
-    frame_period = 1000 * hop / fs
-    f0, t = world.harvest(x, fs, f0_ceil=f0_max, frame_period=frame_period)
-    base_f0 = base_frq(f0, f0_max=f0_max)
+    if block_seconds > 0:
+        logging.info(f'Making {basename}_wav.frq 1/2 in blocks of {block_seconds} seconds')
+        fs = sf.info(floc).samplerate
+        frame_period = 1000 * hop / fs
+        f0, _, _, amp = harvest_blocks(floc, f0_ceil=f0_max, frame_period=frame_period, block_seconds=block_seconds, workers=workers, frame_func=amp_func)
+        base_f0 = base_frq(f0, f0_max=f0_max)
 
-    logging.info(f'Making {basename}_wav.frq 3/4')
-    sp = world.cheaptrick(x, f0, t, fs)
-    amp = np.mean(np.sqrt(sp), axis=1)
-
-    logging.info(f'Making {basename}_wav.frq 4/4')
-    with open(fname + '_wav.frq', 'wb') as f:
-        f.write(b'FREQ0003')
-        f.write(struct.pack('i', hop))
-        f.write(struct.pack('d', base_f0))
-        f.write(bytes(16))
-        f.write(struct.pack('i', f0.shape[0]))
-        for i in range(0, f0.shape[0]):
-            f.write(struct.pack('2d', f0[i], amp[i]))
+        logging.info(f'Making {basename}_wav.frq 2/2')
+    else:
+        logging.info(f'Making {basename}_wav.frq 1/4')
+        x, fs = sf.read(floc)
+        # Blocks don't go through the feature cache, only whole file analyses do
+        cache = world_cache.FeatureCache(cache_dir) if cache_dir else None
+        audio_key = world_cache.file_hash(floc) if cache else None
+
+        logging.info(f'Making {basename}_wav.frq 2/4')
+        frame_period = 1000 * hop / fs
+        f0, t, harvest_key = world_cache.harvest(cache, audio_key, x, fs, f0_ceil=f0_max, frame_period=frame_period)
+        base_f0 = base_frq(f0, f0_max=f0_max)
+
+        logging.info(f'Making {basename}_wav.frq 3/4')
+        if amp_mode == 'rms':
+            amp = amp_func(x, f0, t, fs)
+        else:
+            sp = world_cache.cheaptrick(cache, harvest_key, x, f0, t, fs)
+            amp = np.mean(np.sqrt(sp), axis=1)
+
+        logging.info(f'Making {basename}_wav.frq 4/4')
+    frqfile.write_frq(fname + '_wav.frq', f0, amp, base_f0, hop)
     t = time.perf_counter()
     logging.info(f'{basename}_wav.frq finished at {t - t0:.3f} seconds.')
 
+def audio_duration(floc):
+    try:
+        return sf.info(floc).duration
+    except RuntimeError:
+        return 0
+
+#Sidecar manifest for incremental runs. Remembers the source file and analysis parameters of every .frq it made.
+class Manifest:
+    def __init__(self, root, params):
+        self.root = root
+        self.path = os.path.join(root, manifest_name)
+        self.params = params
+        self.entries = {}
+        self.unsaved = 0
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.entries = json.load(f)
+
+    def key(self, floc):
+        return os.path.relpath(floc, self.root).replace(os.sep, '/')
+
+    def is_fresh(self, floc):
+        entry = self.entries.get(self.key(floc))
+        fname, _ = os.path.splitext(floc)
+        if entry is None or entry['params'] != self.params or not os.path.isfile(fname + '_wav.frq'):
+            return False
+
+        stat = os.stat(floc)
+        if entry['size'] != stat.st_size:
+            return False
+        if entry['mtime'] == stat.st_mtime_ns:
+            return True
+
+        #Touched but maybe not changed. The hash decides
+        if entry['hash'] == world_cache.file_hash(floc):
+            entry['mtime'] = stat.st_mtime_ns
+            self.unsaved += 1
+            return True
+        return False
+
+    def record(self, floc):
+        stat = os.stat(floc)
+        self.entries[self.key(floc)] = {
+            'mtime' : stat.st_mtime_ns,
+            'size' : stat.st_size,
+            'hash' : world_cache.file_hash(floc),
+            'params' : self.params
+        }
+        self.unsaved += 1
+        if self.unsaved >= 100:
+            self.save()
+
+    def save(self):
+        if self.unsaved == 0:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.path)
+        self.unsaved = 0
+
 def process_directory(args):
     samples = []
     logging.info('Received directory. Listing files')
     for root, dirs, files in os.walk(args.path):
         for file in files:
             if file.endswith('.wav'):
-                fname, _ = os.path.splitext(file)
                 samples.append(os.path.join(root, file))
     logging.info(f'Listed {len(samples)} file{"s" if len(samples) != 1 else ""}')
 
-    num_threads = max(0, args.num_threads)
-    if num_threads == 1:
-        logging.info('Running single threaded')
-        t0 = time.perf_counter()
-        for sample in samples:
-            frq_gen(sample)
-        t = time.perf_counter()
-    else:
-        workers = os.cpu_count if num_threads == 0 else num_threads
-        logging.info(f'Starting process pool with {workers} threads.')
-        t0 = time.perf_counter()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
-            executor.map(frq_gen, samples)
-        t = time.perf_counter()
+    params = {'hop' : args.hop, 'f0_max' : args.f0_max, 'amp_mode' : args.amp_mode, 'block_seconds' : args.block_seconds}
+    options = {**params, 'cache_dir' : args.cache}
+    manifest = None
+    on_done = None
+    if args.incremental:
+        manifest = Manifest(args.path, params)
+        on_done = manifest.record
+        fresh = set(sample for sample in samples if manifest.is_fresh(sample))
+        samples = [sample for sample in samples if sample not in fresh]
+        logging.info(f'Skipping {len(fresh)} unchanged file{"s" if len(fresh) != 1 else ""}')
+
+    #Longest files go first so one long take doesn't end up running alone at the end
+    durations = {sample: audio_duration(sample) for sample in samples}
+    samples.sort(key=durations.get, reverse=True)
+
+    workers = job_pool.worker_count(args.num_threads)
+    failed = []
+    try:
+        if workers == 1:
+            logging.info('Running single threaded')
+            t0 = time.perf_counter()
+            for sample in samples:
+                try:
+                    frq_gen(sample, **options)
+                except Exception as e:
+                    job_pool.log_failure(f'Failed to make .frq for {sample}', e)
+                    failed.append(sample)
+                else:
+                    if on_done:
+                        on_done(sample)
+            t = time.perf_counter()
+        else:
+            logging.info(f'Starting process pool with {workers} threads.')
+            t0 = time.perf_counter()
+            jobs = ((sample, partial(frq_gen, sample, **options)) for sample in samples)
+            failed = job_pool.run_pool(jobs, workers, failure='Failed to make .frq for {}', on_done=on_done)
+            t = time.perf_counter()
+    finally:
+        if manifest:
+            manifest.save()
+
+    elapsed = max(t - t0, 1e-9)
+    finished = len(samples) - len(failed)
+    audio_seconds = sum(durations.values()) - sum(durations[sample] for sample in failed)
     logging.info(f'Whole operation took {t - t0:.3f} seconds.')
+    logging.info(f'Made {finished} .frq file{"s" if finished != 1 else ""}: {finished / elapsed:.3f} files/s, {audio_seconds / elapsed:.3f} audio-seconds/s.')
+    if failed:
+        logging.error(f'{len(failed)} file{"s" if len(failed) != 1 else ""} failed:')
+        for sample in failed:
+            logging.error(sample)
 
 if __name__ == '__main__':
     freeze_support()
@@ -105,13 +224,22 @@ if __name__ == '__main__':
         parser = ArgumentParser(description="Generate .frq files using WORLD's Harvest F0 estimation algorithm.")
         parser.add_argument('path', help='The path to a .wav file or a directory with .wav files.')
         parser.add_argument('--num-threads', '-n', type=int, default=1, help='How many threads to use. Default is running single threaded. Input zero to use all available threads.')
+        parser.add_argument('--hop', type=int, default=256, help='Samples per .frq frame. Default is 256.')
+        parser.add_argument('--f0-max', type=float, default=880, help='F0 ceiling for Harvest in Hz. Default is 880.')
+        parser.add_argument('--amp-mode', '-a', choices=amp_modes, default='cheaptrick', help='How to get the amplitude track. cheaptrick averages the CheapTrick spectral envelope, rms takes the RMS of each frame and is much cheaper. Default is cheaptrick.')
+        parser.add_argument('--block-seconds', '-b', type=float, default=0, help='Run Harvest in blocks of this many seconds to keep memory down on long recordings. A single file spreads its blocks over the threads. Default is zero, which reads the whole file at once.')
+        parser.add_argument('--cache', '-c', help='Folder for a WORLD feature cache shared with world_shift. Files analyzed before with the same settings skip Harvest and CheapTrick. Not used with --block-seconds.')
+        parser.add_argument('--cache-size', type=float, default=10240, help='Size limit of the feature cache in MB. The least recently used features are removed after each run. Default is 10240.')
+        parser.add_argument('--incremental', '-i', action='store_true', help=f'Skip .wav files that have not changed since their .frq was made with the same settings. Keeps track of them in {manifest_name}.')
 
         args, _ = parser.parse_known_args()
         if os.path.isfile(args.path):
             logging.info('Received file')
-            frq_gen(args.path)
+            frq_gen(args.path, f0_max=args.f0_max, hop=args.hop, amp_mode=args.amp_mode, block_seconds=args.block_seconds, workers=job_pool.worker_count(args.num_threads), cache_dir=args.cache)
         else:
             process_directory(args)
+        if args.cache:
+            world_cache.FeatureCache(args.cache, args.cache_size * 1024 ** 2).evict()
         os.system('pause')
     except Exception as e:
         for i in traceback.format_exception(e.__class__, e, e.__traceback__):
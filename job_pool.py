@@ -0,0 +1,54 @@
+import os
+import logging
+import traceback
+import concurrent.futures
+
+#Process pool shared by harvest_frq, threaded_noise_remove and world_shift.
+#A job is (name, func) or (name, func, then). func takes no arguments, usually a functools.partial of a module level
+#function so it can be pickled, and name is what gets logged and returned when it fails.
+#then(result) runs in this process once func is done and returns more jobs that need what it made.
+
+def worker_count(num_threads):
+    #Zero or less means all available threads
+    return (os.cpu_count() or 1) if num_threads <= 0 else num_threads
+
+def log_failure(message, e):
+    logging.error(message)
+    for i in traceback.format_exception(e.__class__, e, e.__traceback__):
+        print(i, end='')
+
+def run_pool(jobs, workers, max_pending=None, failure='Failed on {}', on_done=None):
+    #Keeps at most max_pending jobs queued so a huge directory doesn't pile up in the pool. Default is twice the workers.
+    #Jobs from then are queued straight away and count towards max_pending, so new jobs wait until they're done.
+    #on_done(name) is called for every job that finished. Returns the names of the jobs that failed.
+    if max_pending is None:
+        max_pending = 2 * workers
+    failed = []
+    pending = {}
+    jobs = iter(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(pending) < max_pending:
+                job = next(jobs, None)
+                if job is None:
+                    break
+                pending[executor.submit(job[1])] = job
+
+            if not pending:
+                break
+
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                e = future.exception()
+                if e is not None:
+                    log_failure(failure.format(job[0]), e)
+                    failed.append(job[0])
+                    continue
+
+                if len(job) > 2:
+                    for follow_up in job[2](future.result()):
+                        pending[executor.submit(follow_up[1])] = follow_up
+                if on_done:
+                    on_done(job[0])
+    return failed
@@ -0,0 +1,54 @@
+import numpy as np
+from collections import namedtuple
+
+# FREQ0003 layout. Everything is little endian.
+#   8 bytes  b'FREQ0003'
+#   int32    samples per frame (hop)
+#   float64  base frequency
+#   16 bytes padding
+#   int32    frame count
+#   then (float64 f0, float64 amplitude) for every frame
+magic = b'FREQ0003'
+header_dtype = np.dtype([('magic', 'S8'), ('hop', '<i4'), ('base_f0', '<f8'), ('padding', 'V16'), ('count', '<i4')])
+frame_dtype = np.dtype([('f0', '<f8'), ('amp', '<f8')])
+
+Frq = namedtuple('Frq', ['hop', 'base_f0', 'f0', 'amp'])
+
+def write_frq(path, f0, amp, base_f0, hop=256):
+    #Builds the whole file in one buffer so it only takes a single write.
+    count = len(f0)
+    buffer = bytearray(header_dtype.itemsize + count * frame_dtype.itemsize)
+
+    header = np.frombuffer(buffer, dtype=header_dtype, count=1)
+    header['magic'] = magic
+    header['hop'] = hop
+    header['base_f0'] = base_f0
+    header['count'] = count
+
+    frames = np.frombuffer(buffer, dtype=frame_dtype, offset=header_dtype.itemsize)
+    frames['f0'] = f0
+    frames['amp'] = amp
+
+    with open(path, 'wb') as f:
+        f.write(buffer)
+
+def read_header(path):
+    header = np.fromfile(path, dtype=header_dtype, count=1)
+    if header.shape[0] != 1 or header['magic'][0] != magic:
+        raise ValueError(f'{path} is not a FREQ0003 file.')
+    return header[0]
+
+def read_frq(path, mmap=True):
+    #With mmap the f0 and amp columns are views over the file, nothing gets copied until they are used.
+    header = read_header(path)
+    count = int(header['count'])
+    if count == 0:
+        frames = np.zeros(0, dtype=frame_dtype)
+    elif mmap:
+        frames = np.memmap(path, dtype=frame_dtype, mode='r', offset=header_dtype.itemsize, shape=(count,))
+    else:
+        with open(path, 'rb') as f:
+            f.seek(header_dtype.itemsize)
+            frames = np.frombuffer(f.read(count * frame_dtype.itemsize), dtype=frame_dtype)
+
+    return Frq(int(header['hop']), float(header['base_f0']), frames['f0'], frames['amp'])
@@ -1,4 +1,21 @@
 import re
+import sys
+from collections import namedtuple
+
+#Section headers look like [#VERSION], [#SETTING], [#0000], [#PREV] and so on.
+#This matches what comes after the [# of a line that starts with it.
+section_pattern = re.compile(r'(.+)\]')
+#The same headers in the raw bytes of the file, for lazy loading
+raw_section_pattern = re.compile(rb'^\[#(.+)\][^\n]*\n?', re.M)
+
+#Lyrics note_table counts as rests
+rest_lyrics = ['R', 'r', 'pau', 'sil']
+#note_table only looks at section headers and the keys it has columns for
+table_pattern = re.compile(r'^(?:\[#(.+)\].*|(Length|Lyric|NoteNum|Tempo)=(.*))$', re.M)
+
+#One row per note. paths are the files loaded and file is the index of the file each note came from.
+#lyric holds indices into lyrics, so every distinct lyric is only stored once.
+NoteTable = namedtuple('NoteTable', ['paths', 'file', 'length', 'note_num', 'tempo', 'rest', 'lyric', 'lyrics'])
 
 #Envelope class. Largely based on how Delta stores Envelope data.
 class Envelope:
@@ -226,17 +243,10 @@ class Note:
         for k, v in kwargs.items():
             self.note_data[k] = str(v)
 
-    #For converting the Note class back to UTAU formatting
+    #For converting the Note class back to UTAU formatting. Joins the lines once instead of adding them up one by one.
     def __str__(self):
-        string = f'[#{self.note_type}]\n' if not self.isdeleted else '[#DELETE]\n'
-        for k, v in self.note_data.items():
-            string += f'{k}='
-            if v:
-                string += f'{v}\n'
-            else:
-                string += '\n'
-
-        return string
+        header = f'[#{self.note_type}]\n' if not self.isdeleted else '[#DELETE]\n'
+        return header + ''.join([f'{k}={v}\n' if v else f'{k}=\n' for k, v in self.note_data.items()])
 
     def get(self):
         return str(self)
@@ -492,40 +502,245 @@ def create_note(lyric = 'あ', length = 480, note_num = 60, **kwargs):
     note.set_multiple_data(**kwargs)
 
     return note
+
+#Read-only note for tools that go through a lot of USTs. Length, Lyric and NoteNum are parsed once into slots,
+#every other key stays a string in note_data. Use to_note to get a Note that can be edited.
+def pop_int(data, key, default):
+    #Takes an integer out of data. Anything that wouldn't be written back the same as an int, like 480.0,
+    #stays in data as it was and gives None, so loading never fails on it. Note only fails when that value is read.
+    value = data.get(key)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        return None
+    if str(number) != value:
+        return None
+    del data[key]
+    return number
+
+class CompactNote:
+    __slots__ = ('note_type', 'isdeleted', 'length', 'lyric', 'note_num', 'note_data')
+
+    def __init__(self, note_type = 'INSERT', note_data = None):
+        #Takes over note_data instead of copying it. length and note_num are None when they weren't plain integers,
+        #the value is in note_data then.
+        data = {} if note_data is None else note_data
+        self.note_type = note_type
+        self.isdeleted = False
+        self.length = pop_int(data, 'Length', 480)
+        self.lyric = data.pop('Lyric', 'あ')
+        self.note_num = pop_int(data, 'NoteNum', 60)
+        self.note_data = data
+
+    def get_note_type(self):
+        if self.isdeleted:
+            return 'DELETE'
+        else:
+            return self.note_type
+
+    def get_custom_data(self, name):
+        if name == 'Length' and self.length is not None:
+            return str(self.length)
+        elif name == 'Lyric':
+            return self.lyric
+        elif name == 'NoteNum' and self.note_num is not None:
+            return str(self.note_num)
+        return self.note_data.get(name)
+
+    def to_note(self):
+        #Same key order as a Note read straight from the file. Length and NoteNum are already keys of a new Note,
+        #so the ones left in note_data keep their place when it's copied over.
+        res = Note(self.note_type)
+        res.isdeleted = self.isdeleted
+        if self.length is not None:
+            res.note_data['Length'] = str(self.length)
+        res.note_data['Lyric'] = self.lyric
+        if self.note_num is not None:
+            res.note_data['NoteNum'] = str(self.note_num)
+        res.note_data.update(self.note_data)
+        return res
+
+    def __str__(self):
+        return str(self.to_note())
+
+    def get(self):
+        return str(self)
     
+def read_sections(fpath):
+    #Splits a UST into (section name, section body). Headers always start a line with [#,
+    #so the text is cut there in one go and only the header lines go through the regex.
+    #Anything before the first section is skipped.
+    with open(fpath, encoding = 'shiftjis') as f:
+        text = f.read()
+
+    sections = []
+    for part in ('\n' + text).split('\n[#')[1:]:
+        header, _, body = part.partition('\n')
+        match = section_pattern.match(header)
+        if match:
+            sections.append((match.group(1), body))
+        elif sections:
+            #Not a real header, so the line belongs to the section before it
+            name, previous = sections[-1]
+            sections[-1] = (name, f'{previous}\n[#{part}')
+    return sections
+
+def parse_data(body, shared):
+    #key=value pairs, skipping blank lines. Only the first = splits, so values may have = in them.
+    #Keys are interned and values that repeat in the file share one string through shared, long USTs repeat a lot.
+    data = {}
+    for line in body.split('\n'):
+        if line:
+            key, _, value = line.partition('=')
+            data[sys.intern(key)] = shared.setdefault(value, value)
+    return data
+
+def note_table(fpaths, rest_lyrics = rest_lyrics):
+    #Loads one or more USTs into NumPy columns for statistics over a whole database, without making any note objects.
+    #tempo is the tempo each note plays at, carried over from [#SETTING] and earlier tempo changes.
+    #PREV, NEXT and TRACKEND are not notes of the song and are left out.
+    import numpy as np
+    if isinstance(fpaths, str):
+        fpaths = [fpaths]
+
+    codes = {}
+    file, length, note_num, tempo, lyric = [], [], [], [], []
+    for k, fpath in enumerate(fpaths):
+        with open(fpath, encoding = 'shiftjis') as f:
+            text = f.read()
+
+        sections = []
+        for name, key, value in table_pattern.findall(text):
+            if name:
+                sections.append((name, {}))
+            elif sections:
+                sections[-1][1][key] = value
+
+        current_tempo = 120.0
+        for name, data in sections:
+            if name in ('VERSION', 'PREV', 'NEXT', 'TRACKEND'):
+                continue
+            if data.get('Tempo'):
+                current_tempo = float(data['Tempo'])
+            if name == 'SETTING':
+                continue
+            file.append(k)
+            length.append(int(data.get('Length', 480)))
+            note_num.append(int(data.get('NoteNum', 60)))
+            tempo.append(current_tempo)
+            lyric.append(codes.setdefault(data.get('Lyric', 'あ'), len(codes)))
+
+    lyric = np.array(lyric, dtype=np.int32)
+    rest = np.isin(lyric, [codes[x] for x in rest_lyrics if x in codes])
+    return NoteTable(list(fpaths), np.array(file, dtype=np.int32), np.array(length, dtype=np.int64), np.array(note_num, dtype=np.int64),
+                     np.array(tempo, dtype=np.float64), rest, lyric, list(codes))
+
+def index_sections(fpath):
+    #Finds where the body of every section starts and ends in the raw file without decoding the bodies.
+    #\n is never part of a Shift-JIS character, so a [# right after one is always a real header.
+    with open(fpath, 'rb') as f:
+        data = f.read()
+
+    sections = []
+    name = start = None
+    for match in raw_section_pattern.finditer(data):
+        if name is not None:
+            sections.append((name, (data, start, match.start())))
+        name = match.group(1).decode('shiftjis')
+        start = match.end()
+    if name is not None:
+        sections.append((name, (data, start, len(data))))
+    return sections
+
+def decode_section(data, start, end):
+    #Same newlines as reading the file in text mode
+    return data[start:end].decode('shiftjis').replace('\r\n', '\n').replace('\r', '\n')
+
+#Stands in for a note of a lazily loaded UST. Only the note type is known up front, the section is read into
+#a Note (or a CompactNote) the first time anything else is needed, and everything is passed on to it from then on.
+class LazyNote:
+    __slots__ = ('name', 'compact', 'shared', 'data', 'start', 'end', 'note')
+
+    def __init__(self, name, data, start, end, compact = False, shared = None):
+        #Straight into the slots, going through __setattr__ for each one is slow with thousands of notes
+        set_slot = object.__setattr__
+        set_slot(self, 'name', name)
+        set_slot(self, 'compact', compact)
+        set_slot(self, 'shared', {} if shared is None else shared)
+        set_slot(self, 'data', data)
+        set_slot(self, 'start', start)
+        set_slot(self, 'end', end)
+        set_slot(self, 'note', None)
+
+    def decode(self):
+        if self.note is None:
+            data = parse_data(decode_section(self.data, self.start, self.end), self.shared)
+            if self.compact:
+                note = CompactNote(self.name, data)
+            else:
+                note = Note(self.name)
+                note.note_data.update(data)
+            self.note = note
+            self.data = None
+        return self.note
+
+    #These two don't need the note read
+    def get_note_type(self):
+        if self.note is None:
+            return self.name
+        return self.note.get_note_type()
+
+    @property
+    def isdeleted(self):
+        return self.note is not None and self.note.isdeleted
+
+    def __getattr__(self, name):
+        if name in LazyNote.__slots__:
+            raise AttributeError(name)
+        return getattr(self.decode(), name)
+
+    def __setattr__(self, name, value):
+        if name in LazyNote.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.decode(), name, value)
+
+    def __str__(self):
+        return str(self.decode())
+
 #UtauPlugin class. Has data for everything UTAU sends in.
 class UtauPlugin:
-    def __init__(self, fpath):
-        #Should I use codecs for this??? I just don't like dealing with \r\n at all.
-        data_string = open(fpath, encoding = 'shiftjis').readlines()
-        phase = 0
+    def __init__(self, fpath, compact = False, lazy = False):
+        #compact loads the notes as CompactNote, which takes less memory but can't be edited.
+        #lazy only reads the version and settings up front and each note the first time it's used,
+        #for tools that only need a few fields out of a lot of USTs.
         self.settings = {}
         self.prev_note = None
         self.next_note = None
         self.version = None
         self.notes = []
-        #I'm sorry if you're disgusted by this parsing. Even if rewritten, my statement still holds.
-        for line in data_string:
-            sectionMatch = re.match('\[#(.+)\]', line)
-            if sectionMatch:
-                sectionName = sectionMatch.group(1)
-                if sectionName == 'VERSION':
-                    phase = 1
-                elif sectionName == 'SETTING':
-                    phase = 2
-                else:
-                    phase = 3
-                    self.notes.append(Note(sectionName))
-                continue
-            
-            if phase == 1:
-                self.version = line[:-1]
-            elif phase == 2:
-                setStr = line.split('=')
-                self.settings[setStr[0]] = setStr[1][:-1]
-            else:   
-                setStr = line.split('=')
-                self.notes[-1].set_custom_data(setStr[0], setStr[1][:-1])
+        shared = {}
+        for name, body in (index_sections(fpath) if lazy else read_sections(fpath)):
+            if lazy and name in ('VERSION', 'SETTING'):
+                body = decode_section(*body)
+
+            if name == 'VERSION':
+                lines = [line for line in body.split('\n') if line]
+                if lines:
+                    self.version = lines[-1]
+            elif name == 'SETTING':
+                self.settings.update(parse_data(body, shared))
+            elif lazy:
+                self.notes.append(LazyNote(name, *body, compact, shared))
+            elif compact:
+                self.notes.append(CompactNote(name, parse_data(body, shared)))
+            else:
+                #Straight into note_data, the values are already strings
+                note = Note(name)
+                note.note_data.update(parse_data(body, shared))
+                self.notes.append(note)
 
         if self.notes:
             if self.notes[0].get_note_type() == 'PREV':
@@ -548,26 +763,26 @@ class UtauPlugin:
                 notes.append(note)
         return notes
 
-    def __str__(self):
-        string = ''
-        if self.prev_note:
-            string += str(self.prev_note)
-
-        for note in self.notes:
-            string += str(note)
-
+    def all_notes(self):
+        #Every note in file order, PREV and NEXT included
+        notes = [self.prev_note] if self.prev_note else []
+        notes.extend(self.notes)
         if self.next_note:
-            string += str(self.next_note)
+            notes.append(self.next_note)
+        return notes
 
-        return string
+    def __str__(self):
+        return ''.join([str(note) for note in self.all_notes()])
 
     def write(self, fpath, withHeader = False):
+        #Written a chunk of notes at a time instead of building the whole UST as one string first
         with open(fpath, 'w', encoding = 'shiftjis') as f:
             if withHeader:
                 f.write('[#VERSION]\n')
                 f.write(self.version + '\n')
                 f.write('[#SETTING]\n')
-                for k, v in self.settings.items():
-                    f.write(f'{k}={v}\n')
+                f.writelines(f'{k}={v}\n' for k, v in self.settings.items())
 
-            f.write(str(self))
+            notes = self.all_notes()
+            for i in range(0, len(notes), 1000):
+                f.write(''.join([str(note) for note in notes[i:i + 1000]]))
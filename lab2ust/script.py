@@ -4,8 +4,9 @@ import time
 import sys
 import os
 import math
-import struct
 import json
+import numpy as np
+import frqfile
 
 def quantize(x, intensity):
     return int(round(x / intensity)) * intensity
@@ -66,24 +67,13 @@ try:
     #Load in frequency file if it's inputted
     if frq_loc:
         print('Reading .frq file...')
-        with open(frq_loc, 'rb') as f:
-            header_text = f.read(8).decode('utf-8')
-            assert header_text == 'FREQ0003'
+        data = frqfile.read_frq(frq_loc)
+        assert data.hop == 256
 
-            samples_per_frq = struct.unpack('<i', f.read(4))[0]
-            assert samples_per_frq == 256
-
-            f.read(24)
-
-            num_chunks = struct.unpack('<i', f.read(4))[0]
-
-            for i in range(num_chunks):
-                curr = struct.unpack('<2d', f.read(16))[0]
-                if curr <= 55:
-                    frq.append(frq[-1])
-                else:
-                    frq.append(curr)
-        del frq[0]
+        #Carry the last voiced frequency over frames at or below 55 Hz
+        voiced = data.f0 > 55
+        last_voiced = np.maximum.accumulate(np.where(voiced, np.arange(len(voiced)), -1))
+        frq = np.where(last_voiced >= 0, data.f0[np.maximum(last_voiced, 0)], 0)
         
     #Ask if the label is Japanese or not.
     jpn = input('Is this label for Japanese? [y/n] ')
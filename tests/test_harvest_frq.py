@@ -0,0 +1,60 @@
+import numpy as np
+import pyworld as world
+import pytest
+import harvest_frq
+
+#The loop base_frq replaced, kept as the reference
+def base_frq_loop(f0, f0_min=None, f0_max=None):
+    q = 0
+    avg_frq = 0
+    tally = 0
+    N = len(f0)
+
+    if f0_min is None:
+        f0_min = harvest_frq.f0_floor
+
+    if f0_max is None:
+        f0_max = harvest_frq.f0_ceil
+
+    for i in range(N):
+        if f0[i] >= f0_min and f0[i] <= f0_max:
+            if i < 1:
+                q = f0[i+1] - f0[i]
+            elif i == N - 1:
+                q = f0[i] - f0[i-1]
+            else:
+                q = (f0[i+1] - f0[i-1]) / 2
+            weight = 2 ** (-q * q)
+            avg_frq += f0[i] * weight
+            tally += weight
+
+    if tally > 0:
+        avg_frq /= tally
+    return avg_frq
+
+def synthetic_contours():
+    rng = np.random.default_rng(0)
+    t = np.arange(2000) * 0.005
+    vibrato = 220 * np.exp2(0.05 * np.sin(2 * np.pi * 5.5 * t))
+    jumps = np.repeat(rng.uniform(100, 600, 20), 100)
+    gaps = vibrato.copy()
+    gaps[rng.random(len(gaps)) < 0.3] = 0 # unvoiced frames
+    return [vibrato, jumps, gaps, np.zeros(100), np.full(3, 440.0), jumps + rng.normal(0, 0.3, len(jumps))]
+
+def harvest_contour():
+    #Harvest over a sung-like tone with vibrato, a glide and breaths of noise in between
+    fs = 16000
+    rng = np.random.default_rng(1)
+    t = np.arange(2 * fs) / fs
+    f0 = np.where(t < 1, 220, 220 + 110 * (t - 1)) * np.exp2(0.03 * np.sin(2 * np.pi * 5 * t))
+    phase = 2 * np.pi * np.cumsum(f0) / fs
+    x = sum(np.sin(k * phase) / k for k in range(1, 6)) * 0.3
+    x[(t > 0.6) & (t < 0.8)] = rng.normal(0, 0.01, np.count_nonzero((t > 0.6) & (t < 0.8)))
+    contour, _ = world.harvest(x, fs, f0_ceil=880, frame_period=1000 * 256 / fs)
+    return contour
+
+@pytest.mark.parametrize('f0', synthetic_contours() + [harvest_contour()])
+def test_base_frq_matches_loop(f0):
+    assert harvest_frq.base_frq(f0) == pytest.approx(base_frq_loop(f0), rel=1e-12, abs=1e-9)
+    assert harvest_frq.base_frq(f0, f0_max=880) == pytest.approx(base_frq_loop(f0, f0_max=880), rel=1e-12, abs=1e-9)
+    assert harvest_frq.base_frq(f0, 150, 300) == pytest.approx(base_frq_loop(f0, 150, 300), rel=1e-12, abs=1e-9)
@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+import threaded_noise_remove as tnr
+
+fs = 16000
+
+def noisy_tone(seconds=2, seed=0):
+    #Noise up front for the estimate, then a tone with some noise over it
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * fs)) / fs
+    x = 0.3 * np.sin(2 * np.pi * 220 * t) * (t > 0.3)
+    return x + rng.normal(0, 0.02, len(t))
+
+@pytest.mark.parametrize('gain', tnr.gains)
+def test_onesided_matches_complex(gain):
+    x = noisy_tone()
+    onesided = tnr.logmmse(x, fs, onesided=True, gain=gain)
+    full = tnr.logmmse(x, fs, onesided=False, gain=gain)
+    assert onesided.shape == full.shape
+    np.testing.assert_allclose(onesided, full, rtol=0, atol=1e-12)
+
+@pytest.mark.parametrize('block', [1, 333, 4096, 100000])
+def test_blocks_match_whole_file(block):
+    x = noisy_tone()
+    whole = tnr.logmmse(x, fs)
+    denoiser = tnr.LogMMSE(fs)
+    blocks = np.concatenate([denoiser.process(x[i:i+block]) for i in range(0, len(x), block)])
+    np.testing.assert_allclose(blocks, whole, rtol=0, atol=1e-12)
+
+def test_too_short_raises():
+    with pytest.raises(ValueError):
+        tnr.logmmse(noisy_tone(0.1), fs)
@@ -0,0 +1,143 @@
+import os
+import importlib.util
+import pytest
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Both copies of pyutau should stay the same, so both go through the tests
+def load_pyutau(folder):
+    spec = importlib.util.spec_from_file_location(f'{folder}_pyutau', os.path.join(root, folder, 'pyutau.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+copies = [load_pyutau('lab2ust'), load_pyutau('database_stats')]
+
+ust = '''[#VERSION]
+UST Version1.2
+[#SETTING]
+Tempo=120.00
+Tracks=1
+ProjectName=test
+[#PREV]
+Length=480
+Lyric=R
+NoteNum=60
+[#0000]
+Length=480
+Lyric=あ
+NoteNum=60
+Intensity=100
+Flags=
+[#0001]
+Length=240
+Lyric=か
+NoteNum=62
+PBS=-40;0
+PBW=80
+[#0002]
+Length=960
+Lyric=R
+NoteNum=60
+[#NEXT]
+Length=480
+Lyric=さ
+NoteNum=64
+'''
+
+#Output of the UST above with note 0001 deleted, as written before serialization was reworked
+expected_notes = '''[#PREV]
+Length=480
+Lyric=R
+NoteNum=60
+PreUtterance=
+[#0000]
+Length=480
+Lyric=あ
+NoteNum=60
+PreUtterance=
+Intensity=100
+Flags=
+[#DELETE]
+Length=240
+Lyric=か
+NoteNum=62
+PreUtterance=
+PBS=-40;0
+PBW=80
+[#0002]
+Length=960
+Lyric=R
+NoteNum=60
+PreUtterance=
+[#NEXT]
+Length=480
+Lyric=さ
+NoteNum=64
+PreUtterance=
+'''
+
+expected_header = '''[#VERSION]
+UST Version1.2
+[#SETTING]
+Tempo=120.00
+Tracks=1
+ProjectName=test
+'''
+
+@pytest.fixture
+def ust_path(tmp_path):
+    path = tmp_path / 'in.ust'
+    with open(path, 'w', encoding='shiftjis', newline='\r\n') as f:
+        f.write(ust)
+    return path
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def expected_bytes(text):
+    #write uses text mode, so newlines are the platform's
+    return text.replace('\n', os.linesep).encode('shiftjis')
+
+@pytest.mark.parametrize('pyutau', copies)
+@pytest.mark.parametrize('mode', [{}, {'compact' : True}, {'lazy' : True}])
+def test_str_and_write(pyutau, mode, ust_path, tmp_path):
+    plugin = pyutau.UtauPlugin(ust_path, **mode)
+    plugin.notes[1].isdeleted = True
+    assert str(plugin) == expected_notes
+
+    plugin.write(tmp_path / 'out.ust')
+    assert read_bytes(tmp_path / 'out.ust') == expected_bytes(expected_notes)
+
+    plugin.write(tmp_path / 'out_header.ust', withHeader = True)
+    assert read_bytes(tmp_path / 'out_header.ust') == expected_bytes(expected_header + expected_notes)
+
+@pytest.mark.parametrize('pyutau', copies)
+def test_compact_fields(pyutau, ust_path):
+    eager = pyutau.UtauPlugin(ust_path)
+    compact = pyutau.UtauPlugin(ust_path, compact = True)
+    assert [note.length for note in compact.notes] == [note.get_length() for note in eager.notes]
+    assert [note.lyric for note in compact.notes] == [note.get_lyric() for note in eager.notes]
+    assert [note.note_num for note in compact.notes] == [note.get_note_num() for note in eager.notes]
+    for c, e in zip(compact.all_notes(), eager.all_notes()):
+        assert c.get_note_type() == e.get_note_type()
+        for key, value in e.note_data.items():
+            assert c.get_custom_data(key) == value
+        assert c.to_note().note_data == e.note_data
+
+    compact.notes[1].isdeleted = True
+    assert compact.notes[1].get_note_type() == 'DELETE'
+
+@pytest.mark.parametrize('pyutau', copies)
+def test_compact_keeps_values_that_are_not_ints(pyutau, tmp_path):
+    path = tmp_path / 'odd.ust'
+    with open(path, 'w', encoding='shiftjis', newline='\r\n') as f:
+        f.write('[#SETTING]\nTempo=120\n[#0000]\nLength=480.0\nLyric=あ\nNoteNum=060\nIntensity=100\n[#0001]\nLength=\nLyric=い\nNoteNum=61\n')
+
+    compact = pyutau.UtauPlugin(path, compact = True)
+    first, second = compact.notes
+    assert first.length is None and first.get_custom_data('Length') == '480.0'
+    assert first.note_num is None and first.get_custom_data('NoteNum') == '060'
+    assert second.length is None and second.note_num == 61
+    assert str(compact) == str(pyutau.UtauPlugin(path))
@@ -12,138 +12,406 @@ import sys
 import time
 import traceback
 from multiprocessing import freeze_support
-import concurrent.futures
+from functools import lru_cache, partial
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import job_pool
 
-def logmmse(x, sr): # translation of https://raw.githubusercontent.com/braindead/Noise-reduction/master/logmmse.m
-    length = int(np.floor(20 * sr / 1000)) # frame size in samples
-    if length & 1 == 1:
-        length += 1
-    PERC = 50 # window overlap in percent of frame size
-    len1 = int(np.floor(length * PERC / 100))
-    len2 = length - len1 # update rate in samples
+gains = ['expn', 'table']
+temp_prefix = '.denoising_'
+journal_name = 'denoise_journal.txt'
+profile_name = 'noise_profile.npz'
+profile_margin = 0.05 # seconds read around each silence span so the highpass has settled by the time the span starts
+silence_phonemes = ['pau', 'sil']
 
-    win = np.hanning(length) # define window
+# Lookup table for the Log-MMSE gain term exp(0.5 * E1(vk)), linearly interpolated over log(vk).
+# vk = A * gammak stays below 40 since A < 1 and gammak is capped at 40. vk is clipped to [1e-10, 40].
+# With 4096 points the relative error against scipy's expn is at most 1.4e-6 on that range.
+class ExpIntGainTable:
+    def __init__(self, v_min=1e-10, v_max=40, size=4096):
+        self.v_min = v_min
+        self.v_max = v_max
+        self.size = size
+        self.u0 = np.log(v_min)
+        self.du = (np.log(v_max) - self.u0) / (size - 1)
+        self.table = np.exp(0.5 * expn(1, np.exp(self.u0 + self.du * np.arange(size))))
 
-    # Noise magnitude calculations - assuming that the first 6 frames is noise/silence
-    
-    nFFT = 2 * length
-    noise_mean = np.zeros(nFFT, dtype=np.float64)
-    j = 0
-    for m in range(6):
-        noise_mean += np.abs(fft.fft(win * x[j:j+length], nFFT, axis=0))
-        j += length
-    noise_mu = noise_mean / 6
-    noise_mu2 = np.square(noise_mu)
-
-    # allocate memory and initialize various variables
-    
-    x_old = np.zeros(len1, dtype=np.float64)
-    Xk_prev = np.zeros((len1, 1), dtype=np.float64)
-    NFrames = int(np.floor(len(x) / len2) - np.floor(length / len2))
-    xfinal = np.zeros(NFrames * len2, dtype=np.float64)
+    def __call__(self, vk):
+        pos = (np.log(np.clip(vk, self.v_min, self.v_max)) - self.u0) / self.du
+        i = np.minimum(pos.astype(np.intp), self.size - 2)
+        frac = pos - i
+        return self.table[i] + frac * (self.table[i+1] - self.table[i])
 
-    # start processing
+@lru_cache(maxsize=None)
+def gain_table():
+    return ExpIntGainTable()
 
-    k = 0
-    aa = 0.98
-    mu = 0.98
-    eta = 0.15
+# translation of https://raw.githubusercontent.com/braindead/Noise-reduction/master/logmmse.m
+# Keeps its state between calls to process so a file can be fed in blocks.
+class LogMMSE:
+    def __init__(self, sr, batch_frames=1024, onesided=True, gain='expn', noise_mu=None):
+        length = int(np.floor(20 * sr / 1000)) # frame size in samples
+        if length & 1 == 1:
+            length += 1
+        PERC = 50 # window overlap in percent of frame size
+        self.length = length
+        self.len1 = int(np.floor(length * PERC / 100))
+        self.len2 = length - self.len1 # update rate in samples
 
-    ksi_min = 10 ** (-25 / 10)
+        self.win = np.hanning(length) # define window
+        self.nFFT = 2 * length
+        self.batch_frames = batch_frames
 
-    for n in range(NFrames):
-        insign = win * x[k:k+length]
+        # The input is real so the spectrum is symmetric. The onesided path only keeps the nFFT // 2 + 1 non-negative bins
+        self.onesided = onesided
+        self.forward, self.inverse = (fft.rfft, fft.irfft) if onesided else (fft.fft, fft.ifft)
 
-        spec = fft.fft(insign, nFFT)
-        sig = np.abs(spec) # compute the magnitude
-        sig2 = np.square(sig)
+        # expn evaluates the exponential integral exactly, table trades a tiny error for speed
+        self.gain_table = gain_table() if gain == 'table' else None
 
-        gammak = np.minimum(sig2 / noise_mu2, 40) # limit post SNR to avoid overflows
+        self.aa = 0.98
+        self.mu = 0.98
+        self.eta = 0.15
+        self.ksi_min = 10 ** (-25 / 10)
 
-        if n == 0:
-            ksi = aa + (1 - aa) * np.maximum(gammak - 1, 0)
-        else:
-            ksi = aa * Xk_prev / noise_mu2 + (1 - aa) * np.maximum(gammak - 1, 0) # a priori SNR
-            ksi = np.maximum(ksi_min, ksi) # limit ksi to -25 dB
+        # allocate memory and initialize various variables
+        self.buffer = np.zeros(0, dtype=np.float64) # samples that haven't been through a frame yet
+        self.noise_mu2 = None if noise_mu is None else np.square(noise_mu) # a noise profile skips the estimate from the first 6 frames
+        self.x_old = np.zeros(self.len1, dtype=np.float64)
+        self.Xk_prev = np.zeros((self.len1, 1), dtype=np.float64)
+        self.first_frame = True
+
+    def estimate_noise(self, x):
+        # Noise magnitude calculations - assuming that the first 6 frames is noise/silence
+        noise_frames = self.win * x[:6 * self.length].reshape(6, self.length)
+        noise_mu = np.mean(np.abs(self.forward(noise_frames, self.nFFT, axis=1)), axis=0)
+        self.noise_mu2 = np.square(noise_mu)
+
+    def process(self, x):
+        # Returns the denoised samples of every frame that can be finished with what was fed so far.
+        # One frame is always held back, same as the original which skips the last frame that fits.
+        length, len1, len2 = self.length, self.len1, self.len2
+        buffer = x if len(self.buffer) == 0 else np.concatenate((self.buffer, x))
+        if self.noise_mu2 is None:
+            if len(buffer) < 6 * length:
+                self.buffer = buffer
+                return np.zeros(0, dtype=np.float64)
+            self.estimate_noise(buffer)
+
+        NFrames = max(0, len(buffer) // len2 - length // len2)
+        xfinal = np.zeros(NFrames * len2, dtype=np.float64)
+        frames = np.lib.stride_tricks.sliding_window_view(buffer, length)[::len2] # frame n starts at n * len2, no copy
+
+        aa, mu, eta, ksi_min = self.aa, self.mu, self.eta, self.ksi_min
+        noise_mu2 = self.noise_mu2
+        Xk_prev = self.Xk_prev
+        x_old = self.x_old
+
+        # FFTs, inverse FFTs and overlap-add run over batch_frames frames at once.
+        # Only the gain update stays per frame since it depends on the previous frame.
+        for b in range(0, NFrames, self.batch_frames):
+            nb = min(self.batch_frames, NFrames - b)
+            spec = self.forward(self.win * frames[b:b+nb], self.nFFT, axis=1)
+            sigs = np.abs(spec) # compute the magnitude
+            hws = np.empty_like(sigs)
+
+            for i in range(nb):
+                sig = sigs[i]
+                sig2 = np.square(sig)
+
+                gammak = np.minimum(sig2 / noise_mu2, 40) # limit post SNR to avoid overflows
+
+                if self.first_frame:
+                    ksi = aa + (1 - aa) * np.maximum(gammak - 1, 0)
+                    self.first_frame = False
+                else:
+                    ksi = aa * Xk_prev / noise_mu2 + (1 - aa) * np.maximum(gammak - 1, 0) # a priori SNR
+                    ksi = np.maximum(ksi_min, ksi) # limit ksi to -25 dB
 
-        log_sigma_k = gammak * ksi / (1 + ksi) - np.log(1 + ksi)
-        vad_decision = np.sum(log_sigma_k) / length
-        if vad_decision < eta:
-            # noise only frame found
-            noise_mu2 = mu * noise_mu2 + (1 - mu) * sig2
-        # end of vad
+                log_sigma_k = gammak * ksi / (1 + ksi) - np.log(1 + ksi)
+                if self.onesided:
+                    # every bin besides DC and Nyquist also stands for its mirror
+                    vad_decision = (2 * np.sum(log_sigma_k) - log_sigma_k[0] - log_sigma_k[-1]) / length
+                else:
+                    vad_decision = np.sum(log_sigma_k) / length
+                if vad_decision < eta:
+                    # noise only frame found
+                    noise_mu2 = mu * noise_mu2 + (1 - mu) * sig2
+                # end of vad
 
-        A = ksi / (1 + ksi) # Log-MMSE estimator
-        vk = A * gammak
-        ei_vk = 0.5 * expn(1, vk)
-        hw = A * np.exp(ei_vk)
+                A = ksi / (1 + ksi) # Log-MMSE estimator
+                vk = A * gammak
+                if self.gain_table is None:
+                    ei_vk = 0.5 * expn(1, vk)
+                    hw = A * np.exp(ei_vk)
+                else:
+                    hw = A * self.gain_table(vk)
+                hws[i] = hw
 
-        sig = sig * hw
-        Xk_prev = np.square(sig)
+                Xk_prev = np.square(sig * hw)
 
-        xi_w = fft.ifft(hw * spec, nFFT, axis=0)
-        xi_w = np.real(xi_w)
+            xi_w = self.inverse(hws * spec, self.nFFT, axis=1)
+            xi_w = np.real(xi_w)
 
-        xfinal[k:k+len2] = x_old + xi_w[:len1]
-        x_old = xi_w[len1:length]
-        k += len2
+            # overlap-add. len1 == len2 since the overlap is 50%
+            out = xfinal[b*len2:(b+nb)*len2].reshape(nb, len2)
+            out[0] = x_old + xi_w[0, :len1]
+            out[1:] = xi_w[:-1, len1:length] + xi_w[1:, :len1]
+            x_old = xi_w[-1, len1:length]
 
+        self.noise_mu2 = noise_mu2
+        self.Xk_prev = Xk_prev
+        self.x_old = x_old
+        self.buffer = buffer[NFrames * len2:]
+        return xfinal
+
+def logmmse(x, sr, batch_frames=1024, onesided=True, gain='expn', noise_mu=None):
+    denoiser = LogMMSE(sr, batch_frames, onesided, gain, noise_mu)
+    xfinal = denoiser.process(x)
+    if denoiser.noise_mu2 is None:
+        raise ValueError(f'Input is shorter than the {6 * denoiser.length} samples the noise estimate needs')
     return xfinal
+
+def silence_spans(lab_path):
+    # pau/sil spans of an HTS mono label in seconds
+    spans = []
+    with open(lab_path) as f:
+        for line in f:
+            ph = line.strip().split()
+            if len(ph) >= 3 and ph[2] in silence_phonemes:
+                spans.append((int(ph[0]) / (10 ** 7), int(ph[1]) / (10 ** 7)))
+    return spans
+
+def build_noise_profile(samples):
+    # Averages the magnitude spectrum of every Log-MMSE frame inside the pau/sil spans of each sample's matching .lab.
+    # Only the spans are read, each with a short margin for the highpass, never the whole file.
+    # Returns (sample rate, noise_mu), or None if there was no silence to go on.
+    total = None
+    count = 0
+    fs = None
+    for path in samples:
+        lab = os.path.splitext(path)[0] + '.lab'
+        if not os.path.isfile(lab):
+            continue
+        spans = silence_spans(lab)
+        if not spans:
+            continue
+
+        info = sf.info(path)
+        if fs is None:
+            fs = info.samplerate
+            denoiser = LogMMSE(fs)
+            sos = highpass(fs)
+            margin = int(profile_margin * fs)
+        elif info.samplerate != fs:
+            logging.warning(f'Skipping {path} for the noise profile, it is not {fs} Hz')
+            continue
+
+        for start, end in spans:
+            s0 = int(start * fs)
+            s1 = min(int(end * fs), info.frames)
+            if s1 - s0 < denoiser.length:
+                continue
+            r0 = max(0, s0 - margin)
+            data, _ = sf.read(path, start=r0, stop=min(info.frames, s1 + margin))
+            if len(data.shape) == 2:
+                data = np.mean(data, axis=1)
+            segment = signal.sosfiltfilt(sos, data)[s0 - r0:s1 - r0]
+            frames = np.lib.stride_tricks.sliding_window_view(segment, denoiser.length)[::denoiser.len2]
+            mag = np.abs(denoiser.forward(denoiser.win * frames, denoiser.nFFT, axis=1))
+            total = mag.sum(axis=0) if total is None else total + mag.sum(axis=0)
+            count += len(frames)
+
+    if count == 0:
+        return None
+    return fs, total / count
+
+def load_noise_profile(directory, samples, save=True):
+    # Noise profiles are cached per folder, delete the file to make a new one.
+    # save=False still uses a cached profile but keeps a new one to itself, for profiles made from only part of a folder.
+    path = os.path.join(directory, profile_name)
+    if os.path.isfile(path):
+        with np.load(path) as f:
+            return int(f['sr']), f['noise_mu']
+
+    logging.info(f'Making noise profile for {directory or "."}')
+    profile = build_noise_profile(samples)
+    if profile is None:
+        logging.warning(f'No {"/".join(silence_phonemes)} labels found in {directory or "."}. Falling back to the first 120 ms of each file')
+        return None
+    if save:
+        fs, noise_mu = profile
+        np.savez(path, sr=fs, noise_mu=noise_mu)
+    return profile
     
-def remove_noise(path):
+def highpass(fs):
+    nyq = 0.5 * fs
+    cutoff = 100 / nyq
+    return signal.butter(2, cutoff, btype='high', output='sos')
+
+def denoise_blocks(path, new_path, block_seconds, gain='expn', noise_mu=None):
+    # Streams the file through the highpass and Log-MMSE, so memory depends on the block size and not the file length.
+    # sosfiltfilt needs the whole signal, so the highpass runs forward twice instead. Same magnitude response, but not zero phase.
+    info = sf.info(path)
+    fs = info.samplerate
+    sos = highpass(fs)
+    sos = np.vstack([sos, sos])
+    zi = np.zeros((sos.shape[0], 2))
+    denoiser = LogMMSE(fs, gain=gain, noise_mu=noise_mu)
+
+    with sf.SoundFile(new_path, 'w', samplerate=fs, channels=1) as f:
+        for block in sf.blocks(path, blocksize=max(1, int(block_seconds * fs))):
+            # Deal with multi-channel wavs... kinda.
+            if len(block.shape) == 2:
+                block = np.mean(block, axis=1)
+            block, zi = signal.sosfilt(sos, block, zi=zi)
+            f.write(denoiser.process(block))
+
+    # Same as logmmse, a file too short for the noise estimate must not replace the original
+    if denoiser.noise_mu2 is None:
+        raise ValueError(f'{path} is shorter than the {6 * denoiser.length} samples the noise estimate needs')
+
+def fsync_path(path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def fsync_directory(directory):
+    # Makes the rename itself durable. Windows can't open directories, and doesn't need this anyway.
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(directory or '.', os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+def remove_noise(path, block_seconds=0, gain='expn', noise_profile=None):
     t0 = time.perf_counter() # Time operation
     # Deal with filename
     directory, fname = os.path.split(path)
     logging.info(f'Denoising {fname}')
-    new_fname = f'clean_{fname}'
+    new_fname = f'{temp_prefix}{fname}'
     new_path = os.path.join(directory, new_fname)
 
-    # Setup file
-    data, fs = sf.read(path)
+    # The noise profile only applies to files with the sample rate it was made at
+    noise_mu = None
+    if noise_profile is not None and noise_profile[0] == sf.info(path).samplerate:
+        noise_mu = noise_profile[1]
 
-    # Deal with multi-channel wavs... kinda.
-    if len(data.shape) == 2:
-        data = np.mean(data, axis=1)
-    
-    # Setup highpass
-    nyq = 0.5 * fs
-    cutoff = 100 / nyq
-    sos = signal.butter(2, cutoff, btype='high', output='sos')
+    try:
+        if block_seconds > 0:
+            denoise_blocks(path, new_path, block_seconds, gain, noise_mu)
+        else:
+            # Setup file
+            data, fs = sf.read(path)
+
+            # Deal with multi-channel wavs... kinda.
+            if len(data.shape) == 2:
+                data = np.mean(data, axis=1)
+            
+            # Setup highpass
+            sos = highpass(fs)
 
-    # Highpass, Noise remove, Clip
-    data = signal.sosfiltfilt(sos, data)
-    data = logmmse(data, fs)
+            # Highpass, Noise remove, Clip
+            data = signal.sosfiltfilt(sos, data)
+            data = logmmse(data, fs, gain=gain, noise_mu=noise_mu)
 
-    # Save on new path, delete old path. Safety reasons
-    sf.write(new_path, data, fs)
-    os.remove(path)
-    os.rename(new_path, path)
+            sf.write(new_path, data, fs)
+
+        # Save on a temp file in the same folder and swap it in atomically.
+        # A crash leaves either the original or the denoised file, never half of one.
+        fsync_path(new_path)
+        os.replace(new_path, path)
+        fsync_directory(directory)
+    finally:
+        if os.path.exists(new_path):
+            os.remove(new_path)
     t = time.perf_counter()
     logging.info(f'Denoising {fname} took {t - t0:.3f} seconds')
 
+# Journal of finished files for resuming a batch. Only exists while a batch is unfinished.
+class Journal:
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, journal_name)
+        self.finished = set()
+        if os.path.isfile(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                self.finished = set(line.rstrip('\n') for line in f if line.strip())
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def key(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def is_finished(self, path):
+        return self.key(path) in self.finished
+
+    def record(self, path):
+        self.file.write(self.key(path) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self, complete):
+        self.file.close()
+        if complete:
+            os.remove(self.path)
+
 def process_directory(args):
     samples = []
     logging.info('Received directory. Listing files')
     for root, dirs, files in os.walk(args.path):
         for file in files:
-            if file.endswith('.wav'):
+            if file.endswith('.wav') and not file.startswith(temp_prefix):
                 samples.append(os.path.join(root, file))
     logging.info(f'Listed {len(samples)} file{"s" if len(samples) != 1 else ""}')
 
-    if args.single_thread or args.num_threads == 1:
-        logging.info('Running single threaded')
-        t0 = time.perf_counter()
+    params = {'block_seconds' : args.block_seconds, 'gain' : args.gain}
+    journal = None
+    on_done = None
+    if args.journal:
+        journal = Journal(args.path)
+        on_done = journal.record
+        if journal.finished:
+            samples = [sample for sample in samples if not journal.is_finished(sample)]
+            logging.info(f'Resuming. {len(samples)} file{"s" if len(samples) != 1 else ""} left')
+
+    profiles = {}
+    if args.noise_profile:
+        folders = {}
         for sample in samples:
-            remove_noise(sample)
-        t = time.perf_counter()
-    else:
-        logging.info(f'Starting process pool with {args.num_threads} threads.')
-        t0 = time.perf_counter()
-        with concurrent.futures.ProcessPoolExecutor(max_workers=args.num_threads) as executor:
-            executor.map(remove_noise, samples)
-        t = time.perf_counter()
+            folders.setdefault(os.path.dirname(sample), []).append(sample)
+        for directory, folder_samples in folders.items():
+            profiles[directory] = load_noise_profile(directory, folder_samples)
+
+    failed = []
+    complete = False
+    try:
+        if args.single_thread or args.num_threads == 1:
+            logging.info('Running single threaded')
+            t0 = time.perf_counter()
+            for sample in samples:
+                try:
+                    remove_noise(sample, noise_profile=profiles.get(os.path.dirname(sample)), **params)
+                except Exception as e:
+                    job_pool.log_failure(f'Failed to denoise {sample}', e)
+                    failed.append(sample)
+                else:
+                    if on_done:
+                        on_done(sample)
+            t = time.perf_counter()
+        else:
+            logging.info(f'Starting process pool with {args.num_threads} threads.')
+            t0 = time.perf_counter()
+            jobs = ((sample, partial(remove_noise, sample, noise_profile=profiles.get(os.path.dirname(sample)), **params)) for sample in samples)
+            failed = job_pool.run_pool(jobs, args.num_threads, failure='Failed to denoise {}', on_done=on_done)
+            t = time.perf_counter()
+        complete = not failed
+    finally:
+        if journal:
+            journal.close(complete)
     logging.info(f'Whole operation took {t - t0:.3f} seconds')
+    if failed:
+        logging.error(f'{len(failed)} file{"s" if len(failed) != 1 else ""} failed:')
+        for sample in failed:
+            logging.error(sample)
 
 if __name__ == '__main__':
     freeze_support()
@@ -152,11 +420,17 @@ if __name__ == '__main__':
         parser.add_argument('path', help='The path to a .wav file or a directory with .wav files.')
         parser.add_argument('--single-thread', '-s', action='store_true', help='Run single threaded')
         parser.add_argument('--num-threads', '-n', type=int, default=os.cpu_count(), help='How many threads to use. Default is your thread count.')
+        parser.add_argument('--block-seconds', '-b', type=float, default=0, help='Stream each file in blocks of this many seconds to keep memory down on long recordings. The highpass becomes causal in this mode. Default is zero, which reads the whole file at once.')
+        parser.add_argument('--gain', '-g', choices=gains, default='expn', help='How to compute the Log-MMSE gain. expn is exact, table uses a lookup table that is much faster with a relative error below 1.4e-6. Default is expn.')
+        parser.add_argument('--journal', '-j', action='store_true', help=f'Keep a {journal_name} of finished files in the folder so an interrupted run can pick up where it stopped without denoising files twice. It is deleted once every file is done.')
+        parser.add_argument('--noise-profile', '-p', action='store_true', help=f'Make one noise profile per folder from the {"/".join(silence_phonemes)} parts of the .lab files next to the samples instead of using the first 120 ms of each sample. It is saved as {profile_name} in each folder and reused on later runs.')
 
         args, _ = parser.parse_known_args()
         if os.path.isfile(args.path):
             logging.info('Received file')
-            remove_noise(args.path)
+            # One file isn't the whole folder, so its profile isn't saved as the folder's
+            profile = load_noise_profile(os.path.dirname(args.path), [args.path], save=False) if args.noise_profile else None
+            remove_noise(args.path, args.block_seconds, args.gain, profile)
         else:
             process_directory(args)
         os.system('pause')
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import numpy as np
+import pyworld as world
+
+#Content-addressed cache for WORLD features, shared by harvest_frq and world_shift.
+#Every stage is keyed by the hash of the audio and the settings of that stage and the ones before it,
+#so the same .wav analyzed with the same settings by either script is only analyzed once.
+#Each array is its own .npy file so it can be memory mapped back in.
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def make_key(*parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+class FeatureCache:
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def array_path(self, key, name):
+        return os.path.join(self.directory, f'{key}.{name}.npy')
+
+    def load(self, key, names):
+        paths = [self.array_path(key, name) for name in names]
+        try:
+            #Copy on write so pyworld gets writable arrays without reading the whole file up front
+            arrays = tuple(np.load(path, mmap_mode='c') for path in paths)
+        except (FileNotFoundError, ValueError):
+            return None
+        for path in paths:
+            os.utime(path) # Marks the entry as recently used
+        return arrays
+
+    def save(self, key, names, arrays):
+        for name, array in zip(names, arrays):
+            path = self.array_path(key, name)
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                np.save(f, array)
+            os.replace(temp_path, path)
+
+    def cached(self, key, names, compute):
+        arrays = self.load(key, names)
+        if arrays is None:
+            arrays = compute()
+            self.save(key, names, arrays)
+        return arrays
+
+    def evict(self):
+        #Deletes the least recently used arrays until the cache fits in max_bytes
+        entries = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+#How sp and ap are kept between analysis and synthesis, in memory and in the cache.
+#float32 halves them, coded keeps a few dozen cepstral dimensions of sp and the band aperiodicities of ap.
+storages = ['float64', 'float32', 'coded']
+coded_sp_dims = 60
+
+def encode_sp(sp, fs, storage='float64', sp_dims=coded_sp_dims):
+    if storage == 'coded':
+        return world.code_spectral_envelope(sp, fs, sp_dims)
+    return sp.astype(storage, copy=False)
+
+def encode_ap(ap, fs, storage='float64'):
+    if storage == 'coded':
+        return world.code_aperiodicity(ap, fs)
+    return ap.astype(storage, copy=False)
+
+def decode_sp(sp, fs, storage='float64'):
+    #Back to the full float64 envelope synthesize expects
+    sp = np.ascontiguousarray(sp, dtype=np.float64)
+    if storage == 'coded':
+        return world.decode_spectral_envelope(sp, fs, world.get_cheaptrick_fft_size(fs))
+    return sp
+
+def decode_ap(ap, fs, storage='float64'):
+    ap = np.ascontiguousarray(ap, dtype=np.float64)
+    if storage == 'coded':
+        return world.decode_aperiodicity(ap, fs, world.get_cheaptrick_fft_size(fs))
+    return ap
+
+#Each stage goes through the cache when one is given, and is computed as usual when cache is None.
+def harvest(cache, audio_key, x, fs, f0_floor=world.default_f0_floor, f0_ceil=world.default_f0_ceil, frame_period=world.default_frame_period):
+    #Also returns the key the later stages build on
+    compute = lambda: world.harvest(x, fs, f0_floor=f0_floor, f0_ceil=f0_ceil, frame_period=frame_period)
+    if cache is None:
+        return (*compute(), None)
+    key = make_key(audio_key, int(fs), 'harvest', float(f0_floor), float(f0_ceil), float(frame_period)) # 880 and 880.0 should be the same key
+    return (*cache.cached(key, ['f0', 't'], compute), key)
+
+#sp and ap come back encoded with storage. The float64 keys stay the same as before so harvest_frq still shares them.
+def cheaptrick(cache, harvest_key, x, f0, t, fs, storage='float64', sp_dims=coded_sp_dims):
+    compute = lambda: encode_sp(world.cheaptrick(x, f0, t, fs), fs, storage, sp_dims)
+    if cache is None:
+        return compute()
+    if storage == 'float64':
+        key = make_key(harvest_key, 'cheaptrick')
+    else:
+        key = make_key(harvest_key, 'cheaptrick', storage, int(sp_dims) if storage == 'coded' else None)
+    return cache.cached(key, ['sp'], lambda: (compute(),))[0]
+
+def d4c(cache, harvest_key, x, f0, t, fs, threshold=0.85, storage='float64'):
+    compute = lambda: encode_ap(world.d4c(x, f0, t, fs, threshold=threshold), fs, storage)
+    if cache is None:
+        return compute()
+    if storage == 'float64':
+        key = make_key(harvest_key, 'd4c', float(threshold))
+    else:
+        key = make_key(harvest_key, 'd4c', float(threshold), storage)
+    return cache.cached(key, ['ap'], lambda: (compute(),))[0]
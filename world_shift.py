@@ -3,34 +3,112 @@ import soundfile as sf
 import numpy as np
 import pyworld as world
 import os
+import time
 import logging
+from multiprocessing import freeze_support
+from functools import partial
+from argparse import ArgumentParser
+from harvest_blocks import harvest_blocks
+import world_cache
+import job_pool
 
 pitches = [-12, -5, 5, 12]
+block_seconds = 0 # Run Harvest in blocks of this many seconds for long recordings. Zero runs it over the whole file
+storage = 'float64' # How sp and ap are kept until synthesis. float32 or coded take less memory and cache space
 
-def shift_pitch(path):
+def analyze(path, block_seconds=0, hop=None, f0_max=world.default_f0_ceil, cache_dir=None, storage=storage, sp_dims=world_cache.coded_sp_dims):
     loc, _ = os.path.splitext(path)
     directory, fname = os.path.split(loc)
 
     logging.info(f'Loading {fname}')
     x, fs = sf.read(path)
-
+    # Using the same hop and f0 ceiling as harvest_frq lets both share cached features
+    frame_period = world.default_frame_period if hop is None else 1000 * hop / fs
+    # Blocks don't go through the feature cache, only whole file analyses do
+    cache = world_cache.FeatureCache(cache_dir) if cache_dir and block_seconds <= 0 else None
+    audio_key = world_cache.file_hash(path) if cache else None
 
     logging.info(f'Analyzing {fname}')
-    f0, t = world.harvest(x, fs)
-    sp = world.cheaptrick(x, f0, t, fs)
-    ap = world.d4c(x, f0, t, fs, threshold=0.25)
+    if block_seconds > 0:
+        f0, t, _, _ = harvest_blocks(path, f0_ceil=f0_max, frame_period=frame_period, block_seconds=block_seconds)
+        harvest_key = None
+    else:
+        f0, t, harvest_key = world_cache.harvest(cache, audio_key, x, fs, f0_ceil=f0_max, frame_period=frame_period)
+    # sp and ap stay encoded until synthesis, which is what the pool holds on to between the two
+    sp = world_cache.cheaptrick(cache, harvest_key, x, f0, t, fs, storage=storage, sp_dims=sp_dims)
+    ap = world_cache.d4c(cache, harvest_key, x, f0, t, fs, threshold=0.25, storage=storage)
+    return f0, sp, ap, fs, frame_period, storage
+
+def synthesize_shift(path, shift, f0, sp, ap, fs, frame_period=world.default_frame_period, storage='float64'):
+    loc, _ = os.path.splitext(path)
+    directory, fname = os.path.split(loc)
+
+    logging.info(f'Synthesizing {fname} {shift:+}')
+    shift_f0 = f0 * np.exp2(shift / 12)
+    sp = world_cache.decode_sp(sp, fs, storage)
+    ap = world_cache.decode_ap(ap, fs, storage)
+    y = world.synthesize(shift_f0, sp, ap, fs, frame_period=frame_period)
 
-    for i in pitches:
+    sf.write(loc + f'{shift:+}.wav', y, fs)
+
+def shift_pitch(path, shifts=None, block_seconds=block_seconds, hop=None, f0_max=world.default_f0_ceil, cache_dir=None, storage=storage, sp_dims=world_cache.coded_sp_dims):
+    if shifts is None:
+        shifts = pitches
+    features = analyze(path, block_seconds, hop, f0_max, cache_dir, storage, sp_dims)
+
+    for i in shifts:
         if i == 0:
             continue
-        logging.info(f'Synthesizing {fname} {i:+}')
-        shift_f0 = f0 * np.exp2(i / 12)
-        y = world.synthesize(shift_f0, sp, ap, fs)
+        synthesize_shift(path, i, *features)
+
+def run_pool(paths, shifts, workers, analysis):
+    # Each file is analyzed once, then every shift of it is its own synthesis job, so all of them spread over the pool.
+    # Analyses wait while enough work is queued, since every finished analysis holds its sp and ap until synthesized.
+    shifts = [i for i in shifts if i != 0]
 
-        sf.write(loc + f'{i:+}.wav', y, fs)
+    def syntheses(path, features):
+        return [(f'{path} {i:+}', partial(synthesize_shift, path, i, *features)) for i in shifts]
+
+    analyses = ((path, partial(analyze, path, **analysis), partial(syntheses, path)) for path in paths)
+    return job_pool.run_pool(analyses, workers)
 
 if __name__ == '__main__':
+    freeze_support()
     logging.basicConfig(format='%(message)s', level=logging.INFO)
-    for path in glob.glob('*.wav'):
-        shift_pitch(path)
+    parser = ArgumentParser(description='Pitch shifts .wav files with WORLD for data augmentation.')
+    parser.add_argument('path', nargs='?', default='.', help='The folder with the .wav files. Default is the current folder.')
+    parser.add_argument('--pitches', '-p', type=int, nargs='+', default=pitches, help=f'Semitones to shift by. Default is {" ".join(f"{i:+}" for i in pitches)}.')
+    parser.add_argument('--num-threads', '-n', type=int, default=1, help='How many threads to use. Default is running single threaded. Input zero to use all available threads.')
+    parser.add_argument('--block-seconds', '-b', type=float, default=block_seconds, help='Run Harvest in blocks of this many seconds for long recordings. Default is zero, which runs it over the whole file.')
+    parser.add_argument('--hop', type=int, help='Samples per analysis frame. Default is a 5 ms frame period. Use 256 to match harvest_frq.')
+    parser.add_argument('--f0-max', type=float, default=world.default_f0_ceil, help=f'F0 ceiling for Harvest in Hz. Default is {world.default_f0_ceil:g}. Use 880 to match harvest_frq.')
+    parser.add_argument('--cache', '-c', help='Folder for a WORLD feature cache shared with harvest_frq. Files analyzed before with the same settings skip the analysis. Not used with --block-seconds.')
+    parser.add_argument('--cache-size', type=float, default=10240, help='Size limit of the feature cache in MB. The least recently used features are removed after each run. Default is 10240.')
+    parser.add_argument('--storage', '-s', choices=world_cache.storages, default=storage, help=f'How the spectral envelope and aperiodicity are kept until synthesis, in memory and in the cache. float32 halves them, coded keeps only --sp-dims cepstral dimensions of the envelope and the band aperiodicities. Default is {storage}.')
+    parser.add_argument('--sp-dims', type=int, default=world_cache.coded_sp_dims, help=f'Dimensions of the coded spectral envelope with --storage coded. Default is {world_cache.coded_sp_dims}.')
+
+    args, _ = parser.parse_known_args()
+    paths = glob.glob(os.path.join(glob.escape(args.path), '*.wav'))
+    workers = job_pool.worker_count(args.num_threads)
+    analysis = {'block_seconds' : args.block_seconds, 'hop' : args.hop, 'f0_max' : args.f0_max, 'cache_dir' : args.cache, 'storage' : args.storage, 'sp_dims' : args.sp_dims}
 
+    t0 = time.perf_counter()
+    failed = []
+    if workers == 1:
+        for path in paths:
+            try:
+                shift_pitch(path, args.pitches, **analysis)
+            except Exception as e:
+                job_pool.log_failure(f'Failed on {path}', e)
+                failed.append(path)
+    else:
+        logging.info(f'Starting process pool with {workers} threads.')
+        failed = run_pool(paths, args.pitches, workers, analysis)
+    if args.cache:
+        world_cache.FeatureCache(args.cache, args.cache_size * 1024 ** 2).evict()
+    t = time.perf_counter()
+    logging.info(f'Whole operation took {t - t0:.3f} seconds.')
+    if failed:
+        logging.error(f'{len(failed)} job{"s" if len(failed) != 1 else ""} failed:')
+        for job in failed:
+            logging.error(job)